@@ -3,14 +3,150 @@ folium_utils.py
 Funciones para inicializar y enriquecer mapas base en Folium de forma genérica.
 """
 
+import json
 import folium
 from folium.features import DivIcon
-import matplotlib.cm as mcm
-import matplotlib.colors as mcolors
+from branca.element import MacroElement
+from jinja2 import Template
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import MultiPolygon, Polygon
+import shapely
+
+# Número máximo de categorías para mostrar la leyenda por defecto en añadir_poligonos_por_valor
+MAX_CATEGORIAS_LEYENDA = 20
+
+
+def _paleta_hex(cmap_name, n):
+    """
+    Devuelve una lista de n colores hexadecimales muestreados del colormap indicado.
+    La paleta completa se calcula en una sola llamada vectorizada al colormap.
+    """
+    cmap = plt.colormaps[cmap_name].resampled(n)
+    rgba = (cmap(np.arange(n))[:, :3] * 255).astype(np.uint8)
+    return ['#%02x%02x%02x' % tuple(row) for row in rgba]
+
+
+def _como_texto(serie):
+    """
+    Convierte una columna a texto celda a celda (como str(valor)), de modo que los
+    valores nulos se muestran como 'None'/'nan' en lugar de quedar como NaN.
+    """
+    return pd.Series(serie.to_numpy(dtype=object).astype(str), index=serie.index)
+
+
+_LEYENDA_TEMPLATE = Template("""
+{% macro script(this, kwargs) %}
+    var {{ this.get_name() }} = L.control({position: "bottomleft"});
+    {{ this.get_name() }}.onAdd = function () {
+        var div = L.DomUtil.create("div");
+        div.innerHTML = {{ this.html|tojson }};
+        return div;
+    };
+    {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+    {{ this._parent.get_name() }}.on("overlayadd", function (e) {
+        if (e.layer === {{ this.capa.get_name() }}) { {{ this.get_name() }}.addTo({{ this._parent.get_name() }}); }
+    });
+    {{ this._parent.get_name() }}.on("overlayremove", function (e) {
+        if (e.layer === {{ this.capa.get_name() }}) { {{ this.get_name() }}.remove(); }
+    });
+{% endmacro %}
+""")
+
+
+def _añadir_leyenda(m, capa, titulo, colores_por_nombre):
+    """
+    Añade al mapa una leyenda con un recuadro de color por cada (nombre, color).
+    Es un control de Leaflet en la esquina inferior izquierda, así que varias leyendas
+    se apilan en lugar de superponerse, y se oculta o muestra junto con su capa.
+    """
+    filas = "".join(
+        f'<div><span style="display: inline-block; width: 12px; height: 12px; margin-right: 6px; '
+        f'background: {color}; border: 1px solid black"></span>{nombre}</div>'
+        for nombre, color in colores_por_nombre
+    )
+    leyenda = MacroElement()
+    leyenda._name = "Leyenda"
+    leyenda._template = _LEYENDA_TEMPLATE
+    leyenda.capa = capa
+    leyenda.html = (
+        '<div style="background: white; padding: 6px 8px; border: 1px solid grey; '
+        f'border-radius: 4px; font-size: 10pt"><b>{titulo}</b>{filas}</div>'
+    )
+    leyenda.add_to(m)
+
+
+def _aligerar_geometrias(gdf, simplify_tol=None, coord_precision=5):
+    """
+    Reduce el tamaño del GeoJSON que se envía a Leaflet: simplifica las geometrías
+    (si se indica tolerancia, en unidades del CRS de la capa), reproyecta a EPSG:4326
+    y redondea las coordenadas a coord_precision decimales de grado.
+    El redondeo es por coordenada: no valida ni elimina geometrías.
+    """
+    geoms = gdf.geometry.values
+    if simplify_tol:
+        geoms = shapely.simplify(geoms, simplify_tol, preserve_topology=True)
+    gdf = gdf.set_geometry(gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs))
+    if gdf.crs is not None:
+        gdf = gdf.to_crs(epsg=4326)
+    if coord_precision is not None:
+        geoms = shapely.transform(gdf.geometry.values, lambda c: np.round(c, coord_precision))
+        gdf = gdf.set_geometry(gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs))
+    return gdf
+
+
+def _a_geojson(gdf):
+    """
+    Serializa un GeoDataFrame a un diccionario GeoJSON en EPSG:4326.
+    Usa GeoDataFrame.to_json (vía C en Shapely 2) en lugar de __geo_interface__,
+    que es lo que folium.GeoJson emplea por defecto con un GeoDataFrame.
+    """
+    return json.loads(gdf.to_json(drop_id=True, to_wgs84=gdf.crs is not None))
+
+
+def _polys_to_geojson_fast(gdf):
+    """
+    Serializa un GeoDataFrame de polígonos a un diccionario GeoJSON en EPSG:4326.
+    Las coordenadas se extraen de una vez con shapely.to_ragged_array y se reparten
+    por anillos y polígonos según los offsets, sin recorrer objetos Shapely uno a uno.
+    Si las geometrías no son (Multi)Polygon se recurre a _a_geojson.
+    """
+    if gdf.crs is not None:
+        gdf = gdf.to_crs(epsg=4326)
+    geoms = gdf.geometry.values
+    try:
+        geom_type, coords, offsets = shapely.to_ragged_array(geoms)
+    except ValueError:
+        return _a_geojson(gdf)
+    if geom_type == shapely.GeometryType.POLYGON:
+        tipo = "Polygon"
+    elif geom_type == shapely.GeometryType.MULTIPOLYGON:
+        tipo = "MultiPolygon"
+    else:
+        return _a_geojson(gdf)
+
+    # Anillos como listas de coordenadas; después se agrupan en polígonos (y multipolígonos)
+    xy = coords.tolist()
+    partes = [xy[a:b] for a, b in zip(offsets[0][:-1], offsets[0][1:])]
+    for off in offsets[1:]:
+        partes = [partes[a:b] for a, b in zip(off[:-1], off[1:])]
+
+    vacias = shapely.is_missing(geoms) | shapely.is_empty(geoms)
+    # Propiedades con el codificador json estándar (precisión completa, como to_json);
+    # nulos como None y tipos no nativos (fechas, etc.) como texto
+    atributos = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    atributos = atributos.astype(object).where(atributos.notna(), None)
+    props = json.loads(json.dumps(atributos.to_dict("records"), default=str))
+    features = [
+        {
+            "type": "Feature",
+            "properties": prop,
+            "geometry": None if vacia else {"type": tipo, "coordinates": coords_geom},
+        }
+        for prop, coords_geom, vacia in zip(props, partes, vacias)
+    ]
+    return {"type": "FeatureCollection", "features": features}
 
 
 def crear_mapa(lat=None, lon=None, gdf=None, zoom=10, tiles="CartoDB positron", 
@@ -21,7 +157,7 @@ def crear_mapa(lat=None, lon=None, gdf=None, zoom=10, tiles="CartoDB positron",
     Parámetros:
     - lat (float, opcional): Latitud del centro del mapa (usar junto con lon).
     - lon (float, opcional): Longitud del centro del mapa (usar junto con lat).
-    - gdf (GeoDataFrame, opcional): Objeto GeoDataFrame para centrar el mapa en su centroide.
+    - gdf (GeoDataFrame, opcional): Objeto GeoDataFrame para centrar el mapa en el centro de su extensión.
     - zoom (int, opcional): Nivel inicial de zoom (por defecto 10).
     - tiles (str, opcional): Estilo de mapa base. Ejemplos: 
         "OpenStreetMap", "Stamen Terrain", "Stamen Toner", 
@@ -35,8 +171,8 @@ def crear_mapa(lat=None, lon=None, gdf=None, zoom=10, tiles="CartoDB positron",
     """
 
     if gdf is not None:
-        centro = gdf.geometry.union_all().centroid
-        location = [centro.y, centro.x]
+        minx, miny, maxx, maxy = gdf.total_bounds
+        location = [(miny + maxy) / 2, (minx + maxx) / 2]
     elif lat is not None and lon is not None:
         location = [lat, lon]
     else:
@@ -64,7 +200,9 @@ def añadir_puntos(
     lon_col="Longitud",
     color_col=None,
     tooltip_text=None,
-    cmap_name="tab10"
+    cmap_name="tab10",
+    coord_precision=5,
+    name=None
 ):
     """
     Añade puntos al mapa, coloreados por categoría si se indica.
@@ -78,44 +216,68 @@ def añadir_puntos(
         color_col (str): Columna que define el color (opcional).
         tooltip_text (str o lista): Texto o lista de columnas para tooltip.
         cmap_name (str): Nombre del colormap de Matplotlib.
+        coord_precision (int): Decimales conservados en las coordenadas (None para no redondear).
+        name (str, opcional): Nombre de la capa en el LayerControl. Si no se indica, la capa no aparece en él.
     """
     
-    # Preparar colores
+    n = len(gdf)
+
+    # Determinar coordenadas (geometría si existe, columnas lat/lon como respaldo)
+    if "geometry" in gdf.columns:
+        geoms = np.asarray(gdf["geometry"].values)
+        lat_arr, lon_arr = shapely.get_y(geoms), shapely.get_x(geoms)
+        if lat_col in gdf.columns and lon_col in gdf.columns:
+            sin_geom = np.isnan(lat_arr)
+            lat_arr[sin_geom] = gdf[lat_col].to_numpy(dtype=float)[sin_geom]
+            lon_arr[sin_geom] = gdf[lon_col].to_numpy(dtype=float)[sin_geom]
+    else:
+        lat_arr = gdf[lat_col].to_numpy(dtype=float)
+        lon_arr = gdf[lon_col].to_numpy(dtype=float)
+    if np.isnan(lat_arr).any() or np.isnan(lon_arr).any():
+        raise ValueError("Hay puntos sin geometría ni coordenadas de latitud/longitud válidas.")
+    if coord_precision is not None:
+        lat_arr, lon_arr = np.round(lat_arr, coord_precision), np.round(lon_arr, coord_precision)
+    lat_arr, lon_arr = lat_arr.tolist(), lon_arr.tolist()
+
+    # Determinar color de cada punto: códigos de categoría como índices de una tabla de colores
     if color_col:
-        categorias = gdf[color_col].unique()
-        colormap = mcm.get_cmap(cmap_name, len(categorias))
-        color_dict = {cat: mcolors.rgb2hex(colormap(i)) for i, cat in enumerate(categorias)}
+        codes, categorias = pd.factorize(gdf[color_col].to_numpy(), use_na_sentinel=False)
+        hex_lut = np.array(_paleta_hex(cmap_name, len(categorias)), dtype=object)
+        col_arr = hex_lut.take(codes).tolist()
     else:
-        color_dict = {None: "blue"}
-
-    for _, row in gdf.iterrows():
-        # Determinar coordenadas
-        if "geometry" in gdf.columns and row.geometry is not None:
-            lat, lon = row.geometry.y, row.geometry.x
-        else:
-            lat, lon = row[lat_col], row[lon_col]
-
-        # Determinar color
-        color = color_dict[row[color_col]] if color_col else "blue"
-
-        # Preparar tooltip
-        if isinstance(tooltip_text, list):
-            tooltip_html = "<br>".join(f"{col}: {row[col]}" for col in tooltip_text)
-        elif isinstance(tooltip_text, str):
-            tooltip_html = row[tooltip_text] if tooltip_text in gdf.columns else tooltip_text
-        else:
-            tooltip_html = None
-
-        # Añadir marcador
-        folium.CircleMarker(
-            location=[lat, lon],
-            radius=2,
-            color=color,
-            fill=True,
-            fill_color=color,
-            fill_opacity=0.7,
-            tooltip=folium.Tooltip(tooltip_html, sticky=True) if tooltip_html else None
-        ).add_to(m)
+        col_arr = ["blue"] * n
+
+    # Preparar tooltips
+    if isinstance(tooltip_text, list) and tooltip_text:
+        # Concatenación vectorizada de columnas en lugar de un f-string por fila
+        parts = [_como_texto(gdf[col]).radd(f"{col}: ") for col in tooltip_text]
+        tips = parts[0]
+        for p in parts[1:]:
+            tips = tips.str.cat(p, sep="<br>")
+        tips = tips.tolist()
+    elif isinstance(tooltip_text, str):
+        tips = _como_texto(gdf[tooltip_text]).tolist() if tooltip_text in gdf.columns else [tooltip_text] * n
+    else:
+        tips = None
+
+    # Una única FeatureCollection en lugar de un CircleMarker por punto
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon_arr[i], lat_arr[i]]},
+            "properties": {"c": col_arr[i], "t": tips[i] if tips else None},
+        }
+        for i in range(n)
+    ]
+
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name,
+        control=name is not None,
+        marker=folium.CircleMarker(radius=2, fill=True, fill_opacity=0.7),
+        style_function=lambda f: {"color": f["properties"]["c"], "fillColor": f["properties"]["c"]},
+        tooltip=folium.GeoJsonTooltip(fields=["t"], labels=False, sticky=True) if tips else None
+    ).add_to(m)
 
 
 def añadir_poligonos_por_valor(
@@ -126,7 +288,10 @@ def añadir_poligonos_por_valor(
     tooltip_aliases=None,
     cmap_name="tab20",
     fill_opacity=0.4,
-    default_color="#3388ff"
+    default_color="#3388ff",
+    simplify_tol=None,
+    coord_precision=5,
+    leyenda=None
 ):
     """
     Añade polígonos coloreados por un valor único de columna, o con un color por defecto si no se indica.
@@ -140,36 +305,48 @@ def añadir_poligonos_por_valor(
         cmap_name (str): Nombre del colormap de Matplotlib.
         fill_opacity (float): Opacidad del relleno.
         default_color (str): Color por defecto si no se especifica columna de categorías.
+        leyenda (bool, opcional): Añadir una leyenda con el color de cada categoría (si hay columna de categorías).
+            Por defecto solo se añade si hay como mucho MAX_CATEGORIAS_LEYENDA categorías.
+        simplify_tol (float, opcional): Tolerancia de simplificación (en unidades del CRS).
+        coord_precision (int): Decimales de grado conservados en las coordenadas, tras reproyectar a EPSG:4326 (None para no redondear).
     """
-    
+    gdf = _aligerar_geometrias(gdf, simplify_tol, coord_precision)
+
     if columna_nombre:
-        nombres_unicos = gdf[columna_nombre].dropna().unique()
-        cmap = plt.colormaps[cmap_name].resampled(len(nombres_unicos))
-        colores = [cmap(i) for i in range(len(nombres_unicos))]
-        color_map = {
-            nombre: f'#{int(r*255):02x}{int(g*255):02x}{int(b*255):02x}'
-            for nombre, (r, g, b, _) in zip(nombres_unicos, colores)
+        gdf = gdf[gdf[columna_nombre].notna()]
+        if gdf.empty:
+            # Sin categorías válidas no se añade ni la capa ni la leyenda
+            return
+        codes, nombres_unicos = pd.factorize(gdf[columna_nombre])
+        colores = _paleta_hex(cmap_name, len(nombres_unicos))
+
+        # El color de cada polígono viaja como propiedad: el style_function no depende
+        # de cómo se serialice a JSON la categoría (fechas, etc.) y solo hace una búsqueda
+        style_cache = {
+            color: {"fillColor": color, "color": "black", "weight": 1, "fillOpacity": fill_opacity}
+            for color in colores
         }
 
-        for nombre in nombres_unicos:
-            sub_gdf = gdf[gdf[columna_nombre] == nombre]
-            color = color_map[nombre]
-
-            folium.GeoJson(
-                sub_gdf,
-                name=f'<span style="color:{color}">{nombre}</span>',
-                style_function=lambda x, col=color: {
-                    "fillColor": col,
-                    "color": "black",
-                    "weight": 1,
-                    "fillOpacity": fill_opacity
-                },
-                tooltip=folium.GeoJsonTooltip(fields=tooltip_fields, aliases=tooltip_aliases) if tooltip_fields else None
-            ).add_to(m)
+        def _style(feat, _c=style_cache):
+            return _c[feat["properties"]["__color"]]
+
+        # Una única capa con todas las categorías en lugar de una capa por categoría
+        datos = gdf.assign(__color=np.array(colores, dtype=object).take(codes))
+        capa = folium.GeoJson(
+            _polys_to_geojson_fast(datos),
+            name=columna_nombre,
+            style_function=_style,
+            tooltip=folium.GeoJsonTooltip(fields=tooltip_fields, aliases=tooltip_aliases) if tooltip_fields else None
+        ).add_to(m)
+
+        if leyenda is None:
+            leyenda = len(nombres_unicos) <= MAX_CATEGORIAS_LEYENDA
+        if leyenda:
+            _añadir_leyenda(m, capa, columna_nombre, zip(nombres_unicos, colores))
     else:
         # Si no hay columna de categorías, todos los polígonos con color por defecto
         folium.GeoJson(
-            gdf,
+            _polys_to_geojson_fast(gdf),
             style_function=lambda x: {
                 "fillColor": default_color,
                 "color": "black",
@@ -180,7 +357,8 @@ def añadir_poligonos_por_valor(
         ).add_to(m)
 
 
-def añadir_contornos(m, gdf, columna_grupo, color_map=None, emoji_map=None, tooltip_fields=None, tooltip_aliases=None):
+def añadir_contornos(m, gdf, columna_grupo, color_map=None, emoji_map=None, tooltip_fields=None, tooltip_aliases=None,
+                     simplify_tol=None, coord_precision=5):
     """
     Añade contornos agrupados por un valor de columna.
 
@@ -192,6 +370,8 @@ def añadir_contornos(m, gdf, columna_grupo, color_map=None, emoji_map=None, too
         emoji_map (dict): Diccionario valor → emoji.
         tooltip_fields (list): Columnas para tooltip.
         tooltip_aliases (list): Alias de las columnas para tooltip.
+        simplify_tol (float, opcional): Tolerancia de simplificación (en unidades del CRS).
+        coord_precision (int): Decimales de grado conservados en las coordenadas, tras reproyectar a EPSG:4326 (None para no redondear).
 
     Ejemplo:
         color_map = {"Zona A": "red", "Zona B": "blue"}
@@ -199,12 +379,15 @@ def añadir_contornos(m, gdf, columna_grupo, color_map=None, emoji_map=None, too
         tooltip_fields = ["IdRectangu", "Descripcio"]
         añadir_contornos(mapa, gdf, "TipoZona", color_map=color_map, emoji_map=emoji_map, tooltip_fields=tooltip_fields)
     """
+    gdf = _aligerar_geometrias(gdf, simplify_tol, coord_precision)
+
     for valor, grupo in gdf.groupby(columna_grupo):
         color = color_map.get(valor, "#999999") if color_map else "#999999"
         emoji = emoji_map.get(valor, "") if emoji_map else ""
+        data_json = _polys_to_geojson_fast(grupo)
 
         folium.GeoJson(
-            data=grupo,
+            data=data_json,
             name=f"{emoji} {valor}" if emoji else str(valor),
             style_function=lambda x, col=color: {
                 "fillColor": col,
@@ -234,18 +417,27 @@ def añadir_etiquetas_por_poligono(m, gdf, columna, color_texto="black"):
             color_texto="darkblue"
             )
     """
-    for _, row in gdf.iterrows():
-        valor = row[columna]
-        geom = row["geometry"]
-
-        geoms = list(geom.geoms) if isinstance(geom, MultiPolygon) else [geom] if isinstance(geom, Polygon) else []
-        for poly in geoms:
-            centroide = poly.centroid
-            folium.Marker(
-                location=[centroide.y, centroide.x],
-                icon=DivIcon(
-                    icon_size=(100, 20),
-                    icon_anchor=(0, 0),
-                    html=f'<div style="font-size: 11pt; font-weight: bold; color: {color_texto}">{valor}</div>',
-                )
-            ).add_to(m)
\ No newline at end of file
+    # Separar MultiPolygon en sus partes y quedarse solo con polígonos
+    parts, idx = shapely.get_parts(gdf.geometry.values, return_index=True)
+    es_poligono = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, idx = parts[es_poligono], idx[es_poligono]
+
+    # Centroides calculados de forma vectorizada sobre el array de partes
+    centroides = shapely.centroid(parts)
+    xs = shapely.get_x(centroides)
+    ys = shapely.get_y(centroides)
+    valores = gdf[columna].to_numpy()[idx]
+
+    # Plantilla HTML con el color fijo; solo varía el texto de cada etiqueta
+    tmpl = f'<div style="font-size: 11pt; font-weight: bold; color: {color_texto}">{{v}}</div>'
+    htmls = [tmpl.format(v=v) for v in valores]
+
+    for h, x, y in zip(htmls, xs, ys):
+        folium.Marker(
+            location=[y, x],
+            icon=DivIcon(
+                icon_size=(100, 20),
+                icon_anchor=(0, 0),
+                html=h,
+            )
+        ).add_to(m)
\ No newline at end of file
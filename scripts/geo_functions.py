@@ -7,11 +7,13 @@
 import sys
 import os
 import warnings
+import numpy as np
 import pandas as pd
 from pandas._typing import MergeHow
 import geopandas as gpd
+import shapely
 from shapely import wkt  
-from shapely.geometry import Point, Polygon, MultiPolygon, LineString
+from shapely.geometry import LineString
 
 # Añadir directorio raíz al path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -21,13 +23,31 @@ warnings.simplefilter(action='ignore', category=UserWarning)
 # FUNCIONES DE GEOPANDAS / ESPACIALES
 # ====================================
 
-def import_shp_as_gpd(shapefile: str) -> gpd.GeoDataFrame:
+def import_shp_as_gpd(shapefile: str, columns: list | None = None) -> gpd.GeoDataFrame:
     """Importa shapefile como GeoDataFrame con CRS EPSG:4326.
 
+    Usa el motor pyogrio (con transporte Arrow si pyarrow está instalado) y,
+    si no está disponible, Fiona. Con columns solo se leen esas columnas de atributos.
+
     Ejemplo:
         gdf = import_shp_as_gpd("/ruta/archivo.shp")
+        gdf = import_shp_as_gpd("/ruta/archivo.shp", columns=["IdRectangu"])
     """
-    gdf = gpd.read_file(shapefile)
+    kwargs = {}
+    try:
+        import pyogrio  # noqa: F401
+        kwargs["engine"] = "pyogrio"
+        try:
+            import pyarrow  # noqa: F401
+            kwargs["use_arrow"] = True
+        except ImportError:
+            pass
+    except ImportError:
+        kwargs["engine"] = "fiona"
+    if columns is not None:
+        kwargs["columns"] = columns
+
+    gdf = gpd.read_file(shapefile, **kwargs)
     return gdf.to_crs(epsg=4326) if gdf.crs else gdf.set_crs(epsg=4326)
 
 from shapely import wkt  # Necesario para convertir WKT a geometría
@@ -35,16 +55,14 @@ from shapely import wkt  # Necesario para convertir WKT a geometría
 def pd_to_gpd(df: pd.DataFrame, longitud_col: str = "longitude", latitud_col: str = "latitude") -> gpd.GeoDataFrame:
     """Convierte un DataFrame a GeoDataFrame usando columnas de latitud/longitud o geometría en WKT."""
 
-    df = df.copy()
-
     if longitud_col in df.columns and latitud_col in df.columns:
-        geometry = [Point(xy) for xy in zip(df[longitud_col], df[latitud_col])]
+        geometry = gpd.points_from_xy(df[longitud_col].to_numpy(), df[latitud_col].to_numpy())
         return gpd.GeoDataFrame(df, geometry=geometry, crs='EPSG:4326')
 
     if "geometry" in df.columns and df["geometry"].dtype == "object":
         try:
-            df["geometry"] = gpd.GeoSeries.from_wkt(df["geometry"])
-            return gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
+            geometry = gpd.GeoSeries.from_wkt(df["geometry"], crs="EPSG:4326")
+            return gpd.GeoDataFrame(df.assign(geometry=geometry), geometry="geometry", crs="EPSG:4326")
         except Exception as e:
             raise ValueError(f"No se pudo convertir la columna 'geometry' desde WKT: {e}")
 
@@ -52,21 +70,25 @@ def pd_to_gpd(df: pd.DataFrame, longitud_col: str = "longitude", latitud_col: st
 
 
 def drop_z(geom):
-    """Convertir geometrías a 2D eliminando coordenada Z
+    """Convertir una geometría a 2D eliminando coordenada Z.
+
+    Para una columna completa es preferible usar drop_z_array.
 
     Ejemplo:
-        gdf["geometry"] = gdf["geometry"].apply(drop_z)
+        geom_2d = drop_z(geom)
     """
     if geom is None:
         return None
-    if isinstance(geom, Polygon):
-        return Polygon(
-            [(x, y) for x, y, *_ in geom.exterior.coords],
-            [ [(x, y) for x, y, *_ in ring.coords] for ring in geom.interiors ]
-        )
-    elif isinstance(geom, MultiPolygon):
-        return MultiPolygon([drop_z(p) for p in geom.geoms])
-    return geom
+    return shapely.force_2d(geom)
+
+
+def drop_z_array(geoms):
+    """Convertir un array de geometrías a 2D eliminando coordenada Z de forma vectorizada.
+
+    Ejemplo:
+        gdf["geometry"] = drop_z_array(gdf.geometry.values)
+    """
+    return shapely.force_2d(np.asarray(geoms))
 
 
 def generar_trayectoria(df, lat_col="Latitud", lon_col="Longitud", fecha_col="FcIval"):
@@ -87,18 +109,18 @@ def generar_trayectoria(df, lat_col="Latitud", lon_col="Longitud", fecha_col="Fc
     # Ordenar por fecha
     df_sorted = df.sort_values(fecha_col)
 
-    # Determinar coordenadas
+    # Determinar coordenadas como array (N, 2)
     if "geometry" in df_sorted.columns:
-        coords = [(geom.x, geom.y) for geom in df_sorted.geometry]
+        coords = shapely.get_coordinates(df_sorted.geometry.values)
     else:
-        coords = list(zip(df_sorted[lon_col], df_sorted[lat_col]))
+        coords = np.column_stack((df_sorted[lon_col].to_numpy(), df_sorted[lat_col].to_numpy()))
 
     # Crear LineString
     linea = LineString(coords)
 
-    # Calcular tiempo total de ruta
-    tiempo_total = (pd.to_datetime(df_sorted[fecha_col].iloc[-1]) -
-                    pd.to_datetime(df_sorted[fecha_col].iloc[0])).total_seconds() / 3600  # horas
+    # Calcular tiempo total de ruta (solo se convierten la primera y la última fecha)
+    fechas = pd.to_datetime(df_sorted[fecha_col].values[[0, -1]])
+    tiempo_total = (fechas[1] - fechas[0]).total_seconds() / 3600  # horas
 
     # Crear GeoDataFrame
     gdf_trayectoria = gpd.GeoDataFrame(
@@ -110,19 +132,73 @@ def generar_trayectoria(df, lat_col="Latitud", lon_col="Longitud", fecha_col="Fc
     return gdf_trayectoria
 
 
-def exportar_gdf_shapefile(gdf: gpd.GeoDataFrame, path_out: str, overwrite: bool = True) -> None:
-    """Exporta un GeoDataFrame a shapefile en EPSG:4326.
+def build_index(gdf: gpd.GeoDataFrame) -> shapely.STRtree:
+    """Construye un índice espacial STRtree sobre las geometrías del GeoDataFrame.
+
+    El índice se crea una sola vez y se reutiliza en consultas posteriores.
 
     Ejemplo:
-        exportar_gdf_shapefile(gdf, "./salida.shp")
+        tree = build_index(gdf_rectangulos)
+    """
+    return shapely.STRtree(gdf.geometry.values)
+
+
+def query_points(tree: shapely.STRtree, xs, ys) -> np.ndarray:
+    """Consulta qué geometrías del índice intersecan cada punto (xs, ys).
+
+    Retorna un array (2, N): fila 0 con la posición de cada punto y fila 1 con la
+    posición de la geometría del índice que lo contiene.
+
+    Ejemplo:
+        idx_puntos, idx_rect = query_points(tree, df["Longitud"], df["Latitud"])
+    """
+    geoms = shapely.points(np.asarray(xs), np.asarray(ys))
+    return tree.query(geoms, predicate='intersects')
+
+
+def exportar_gdf(gdf: gpd.GeoDataFrame, path_out: str, driver: str = "FlatGeobuf", overwrite: bool = True) -> None:
+    """Exporta un GeoDataFrame en EPSG:4326 al formato indicado.
+
+    Formatos: 'FlatGeobuf', 'GPKG' (vía pyogrio, o Fiona si no está instalado), 'Parquet' (GeoParquet) o
+    cualquier otro driver de GDAL, como 'ESRI Shapefile' (vía GeoDataFrame.to_file).
+
+    Ejemplo:
+        exportar_gdf(gdf, "./salida.fgb")
+        exportar_gdf(gdf, "./salida.parquet", driver="Parquet")
     """
     if gdf.empty:
         raise ValueError("GeoDataFrame vacío.")
-    if not gdf.geometry.is_valid.all():
-        raise ValueError("Geometrías inválidas.")
+    valid_mask = shapely.is_valid(gdf.geometry.values)
+    if not valid_mask.all():
+        bad = np.flatnonzero(~valid_mask)
+        raise ValueError(f"Geometrías inválidas en índices {gdf.index[bad[:10]].tolist()}")
 
     path_out = os.path.abspath(path_out)
     if os.path.exists(path_out) and not overwrite:
         raise FileExistsError(f"'{path_out}' ya existe y overwrite=False.")
 
-    gdf.to_crs(epsg=4326).to_file(path_out, driver='ESRI Shapefile', encoding='utf-8')
\ No newline at end of file
+    gdf = gdf.to_crs(epsg=4326)
+    if driver == "Parquet":
+        gdf.to_parquet(path_out)
+    elif driver in ("FlatGeobuf", "GPKG"):
+        # Sin índice espacial FlatGeobuf conserva el orden de las filas
+        opciones = {"SPATIAL_INDEX": "NO"} if driver == "FlatGeobuf" else {}
+        try:
+            import pyogrio
+        except ImportError:
+            pyogrio = None
+        if pyogrio is not None:
+            pyogrio.write_dataframe(gdf, path_out, driver=driver, **opciones)
+        else:
+            gdf.to_file(path_out, driver=driver, engine="fiona", **opciones)
+    else:
+        gdf.to_file(path_out, driver=driver, encoding='utf-8')
+
+
+def exportar_gdf_shapefile(gdf: gpd.GeoDataFrame, path_out: str, overwrite: bool = True) -> None:
+    """Exporta un GeoDataFrame a shapefile en EPSG:4326.
+
+    Ejemplo:
+        exportar_gdf_shapefile(gdf, "./salida.shp")
+    """
+    exportar_gdf(gdf, path_out, driver='ESRI Shapefile', overwrite=overwrite)
\ No newline at end of file